@@ -1,9 +1,12 @@
 
 import streamlit as st
 import os
-import base64
+import asyncio
+import io
 import json
-from services.gemini_service import analyze_try_on, generate_virtual_try_on_image
+from PIL import Image, ImageOps
+from services.gemini_service import synthesize_try_on
+from services.result_cache import result_key, manifest_key, load_result, save_result
 
 # Page Config
 st.set_page_config(
@@ -78,32 +81,67 @@ with col_lab:
             st.warning("Please upload a person and at least one garment asset.")
         else:
             try:
-                def to_b64(f):
-                    return base64.b64encode(f.getvalue()).decode() if f else None
+                def to_bytes(f):
+                    # Downscale and re-encode so each Gemini upload is a compact RGB JPEG
+                    if not f:
+                        return None
+                    img = Image.open(f)
+                    # Let the JPEG decoder downscale (1/2, 1/4, 1/8) toward the target size
+                    scale = 1536 / max(img.size)
+                    if scale < 1:
+                        img.draft("RGB", (round(img.width * scale), round(img.height * scale)))
+                    img = ImageOps.exif_transpose(img)
+                    if img.mode in ("RGBA", "LA", "P"):
+                        img = img.convert("RGBA")
+                        flat = Image.new("RGB", img.size, (255, 255, 255))
+                        flat.paste(img, mask=img.getchannel("A"))
+                        img = flat
+                    else:
+                        img = img.convert("RGB")
+                    img.thumbnail((1536, 1536), Image.LANCZOS)
+                    buf = io.BytesIO()
+                    img.save(buf, format="JPEG", quality=85)
+                    return buf.getvalue()
                 
-                p_b64 = to_b64(person_img)
-                t_b64 = to_b64(top_img)
-                b_b64 = to_b64(bottom_img)
-                d_b64 = to_b64(dress_img)
+                p_bytes = to_bytes(person_img)
+                t_bytes = to_bytes(top_img)
+                b_bytes = to_bytes(bottom_img)
+                d_bytes = to_bytes(dress_img)
+                request_key = result_key(p_bytes, t_bytes, b_bytes, d_bytes, gender)
                 
                 with st.status("Initializing Hybrid Pipeline...", expanded=True) as status:
-                    st.write("Step 1: Running CV (YOLOv8 + MediaPipe)...")
-                    analysis = analyze_try_on(p_b64, t_b64, b_b64, d_b64, gender)
+                    # Identical uploads skip CV and both Gemini calls entirely
+                    cached_result = load_result(request_key)
+                    if cached_result:
+                        st.write("Identical request found. Restoring cached synthesis...")
+                        st.session_state.result = cached_result
+                        status.update(label="Synthesis Complete (cached)", state="complete")
+                    else:
+                        # Manifests describe the garments, so reuse one for the same assets
+                        garment_key = manifest_key(t_bytes, b_bytes, d_bytes, gender)
+                        manifests = st.session_state.setdefault("manifests", {})
+                        cached_prompt = manifests.get(garment_key)
                     
-                    st.write("Step 2: Analysis Complete. Generating Virtual Try-On...")
-                    result_img = generate_virtual_try_on_image(
-                        p_b64, t_b64, b_b64, d_b64,
-                        analysis['technicalPrompt'], 
-                        analysis.get('bodySize', 'M'), 
-                        gender
-                    )
+                        st.write("Step 1: Running CV (YOLOv8 + MediaPipe)...")
+                        if cached_prompt:
+                            st.write("Step 2: Cached manifest found. Generating without waiting for analysis...")
+                        else:
+                            st.write("Step 2: Generating Virtual Try-On once analysis completes...")
+                        analysis, result_img = asyncio.run(synthesize_try_on(
+                            p_bytes, t_bytes, b_bytes, d_bytes, gender,
+                            cached_prompt=cached_prompt
+                        ))
+                        # Only the person-independent manifest carries over to other portraits
+                        if analysis.get('garmentManifest'):
+                            manifests[garment_key] = analysis['garmentManifest']
                     
-                    if result_img:
-                        st.session_state.result = {"image": result_img, "analysis": analysis}
-                        status.update(label="Synthesis Complete", state="complete")
-                    else:
-                        st.error("Neural Synthesis returned an empty result. Check API quotas or safety filters.")
-                        status.update(label="Synthesis Failed", state="error")
+                        if result_img:
+                            st.session_state.result = {"image": result_img, "analysis": analysis}
+                            save_result(request_key, st.session_state.result)
+                            status.update(label="Synthesis Complete", state="complete")
+                        else:
+                            st.error("Neural Synthesis returned an empty result. Check API quotas or safety filters.")
+                            status.update(label="Synthesis Failed", state="error")
             except Exception as e:
                 st.error(f"System Error: {str(e)}")
     st.markdown('</div>', unsafe_allow_value=True)
@@ -1,37 +1,199 @@
 
 import os
 import json
+import threading
+import asyncio
 import base64
 import numpy as np
+import streamlit as st
 import cv2
 from PIL import Image
 import io
+from concurrent.futures import ThreadPoolExecutor
 from google import genai
 from google.genai import types
-from ultralytics import YOLO
+from numba import njit
+import onnxruntime as ort
 import mediapipe as mp
 
-# Initialize CV Models
-try:
-    yolo_model = YOLO('yolov8n.pt') 
-except Exception as e:
-    print(f"YOLO Initialization Warning: {e}")
-    yolo_model = None
+YOLO_IMGSZ = 640
+# Both models downscale internally, so never decode beyond this
+CV_MAX_SIDE = 1024
+YOLO_CONF = 0.4
+YOLO_WEIGHTS = 'yolov8n.pt'
+YOLO_ONNX = 'yolov8n.onnx'
+
+def load_yolo():
+    """
+    Opens a plain ONNXRuntime session for YOLOv8n, exporting the PyTorch
+    weights on first boot. If the export or session fails, falls back to the
+    ultralytics PyTorch model so detection stays on.
+    """
+    try:
+        if not os.path.exists(YOLO_ONNX):
+            from ultralytics import YOLO
+            YOLO(YOLO_WEIGHTS).export(format='onnx', imgsz=YOLO_IMGSZ, simplify=True, opset=17)
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = os.cpu_count() or 1
+        return ort.InferenceSession(YOLO_ONNX, sess_options=sess_options, providers=['CPUExecutionProvider'])
+    except Exception as e:
+        print(f"YOLO ONNX Warning: {e}. Falling back to PyTorch weights.")
+        from ultralytics import YOLO
+        return YOLO(YOLO_WEIGHTS)
+
+# Reused across requests instead of reallocated
+_YOLO_BUF = np.empty((1, 3, YOLO_IMGSZ, YOLO_IMGSZ), dtype=np.float32)
+_LETTERBOX_BUF = np.empty((YOLO_IMGSZ, YOLO_IMGSZ, 3), dtype=np.uint8)
+_yolo_lock = threading.Lock()
 
 # MediaPipe for skeletal telemetry
 mp_pose = mp.solutions.pose
-pose_engine = mp_pose.Pose(static_image_mode=True, min_detection_confidence=0.5)
+CRITICAL_LANDMARKS = [
+    mp_pose.PoseLandmark.LEFT_SHOULDER,
+    mp_pose.PoseLandmark.RIGHT_SHOULDER,
+    mp_pose.PoseLandmark.LEFT_HIP,
+    mp_pose.PoseLandmark.RIGHT_HIP,
+]
+CRITICAL_LANDMARK_NAMES = ["L_Shoulder", "R_Shoulder", "L_Hip", "R_Hip"]
+# Single worker: the Pose graph is not safe to drive from several threads
+pose_pool = ThreadPoolExecutor(max_workers=1)
 
+# Heavy singletons live in st.cache_resource so reruns and hot reloads
+# never rebuild them; each loader warms its model before handing it out.
+@st.cache_resource(show_spinner=False)
+def get_yolo():
+    # Load failures raise instead of returning None: st.cache_resource does not
+    # cache exceptions, so the next request retries the load
+    model = load_yolo()
+    try:
+        _detect_person(model, np.zeros((YOLO_IMGSZ, YOLO_IMGSZ, 3), dtype=np.uint8))
+    except Exception as e:
+        print(f"YOLO Warm-up Warning: {e}")
+    return model
+
+@st.cache_resource(show_spinner=False)
+def get_pose():
+    # Lite landmarker is plenty for shoulders/hips; the full model is a fallback
+    engines = (
+        mp_pose.Pose(static_image_mode=True, model_complexity=0, min_detection_confidence=0.5),
+        mp_pose.Pose(static_image_mode=True, model_complexity=1, min_detection_confidence=0.5),
+    )
+    dummy = np.zeros((YOLO_IMGSZ, YOLO_IMGSZ, 3), dtype=np.uint8)
+    try:
+        for engine in engines:
+            engine.process(dummy)
+    except Exception as e:
+        print(f"Pose Warm-up Warning: {e}")
+    return engines
+
+@st.cache_resource(show_spinner=False)
 def get_client():
+    # Saves client construction per call; google-genai 1.3.0 still opens a
+    # fresh HTTP session per request, so connections are not pooled
     return genai.Client(api_key=os.environ["API_KEY"])
 
-def process_cv_grounding(image_b64):
+@njit("Tuple((float64[::1], float64, float64, float64))(float32[:, ::1], float64)", cache=True, fastmath=True)
+def _compute_skeleton_metrics(points, aspect):
+    """
+    Geometry over the critical points (L/R shoulder, L/R hip): torso box,
+    shoulder width, shoulder-to-hip height and shoulder tilt in degrees.
+    MediaPipe normalizes x by width and y by height, so x is scaled by the
+    image aspect (width / height) first; lengths come out as fractions of
+    the image height and the tilt is the true on-image angle.
+    """
+    box = np.empty(4, dtype=np.float64)
+    box[0] = points[:, 0].min()
+    box[1] = points[:, 1].min()
+    box[2] = points[:, 0].max()
+    box[3] = points[:, 1].max()
+    dx = np.float64(points[0, 0] - points[1, 0]) * aspect
+    dy = np.float64(points[0, 1] - points[1, 1])
+    shoulder_width = np.sqrt(dx * dx + dy * dy)
+    mid_dx = np.float64(points[0, 0] + points[1, 0] - points[2, 0] - points[3, 0]) / 2 * aspect
+    mid_dy = np.float64(points[0, 1] + points[1, 1] - points[2, 1] - points[3, 1]) / 2
+    torso_height = np.sqrt(mid_dx * mid_dx + mid_dy * mid_dy)
+    tilt_angle = np.degrees(np.arctan2(dy, dx))
+    return box, shoulder_width, torso_height, tilt_angle
+
+def _decode_image(img_bytes):
+    """
+    Decodes straight to an RGB array so MediaPipe needs no colour conversion.
+    """
+    try:
+        img = np.asarray(Image.open(io.BytesIO(img_bytes)).convert("RGB"))
+    except Exception:
+        return None
+    scale = CV_MAX_SIDE / max(img.shape[:2])
+    if scale < 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return img
+
+def _letterbox(img, canvas):
+    """
+    Aspect-preserving resize onto a grey YOLO_IMGSZ square, as ultralytics does,
+    written in place into canvas. Returns the scale and padding needed to map
+    boxes back.
+    """
+    h, w = img.shape[:2]
+    scale = YOLO_IMGSZ / max(h, w)
+    new_w, new_h = round(w * scale), round(h * scale)
+    pad_x, pad_y = (YOLO_IMGSZ - new_w) // 2, (YOLO_IMGSZ - new_h) // 2
+    canvas.fill(114)
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    cv2.resize(img, (new_w, new_h), dst=canvas[pad_y:pad_y + new_h, pad_x:pad_x + new_w], interpolation=interpolation)
+    return scale, pad_x, pad_y
+
+def _detect_person(session, img):
+    """
+    Runs YOLOv8n over an RGB image and returns the most confident person box
+    as normalized [x1, y1, x2, y2], or None.
+    """
+    if not isinstance(session, ort.InferenceSession):
+        # PyTorch fallback; ultralytics expects BGR arrays
+        results = session(img[..., ::-1], classes=[0], verbose=False, imgsz=YOLO_IMGSZ, max_det=1, conf=YOLO_CONF)
+        if len(results) == 0 or len(results[0].boxes) == 0:
+            return None
+        return results[0].boxes.xyxyn.cpu().numpy().astype(np.float64).round(3)[0].tolist()
+
+    # The shared buffers make concurrent Streamlit sessions take turns
+    with _yolo_lock:
+        scale, pad_x, pad_y = _letterbox(img, _LETTERBOX_BUF)
+        np.copyto(_YOLO_BUF[0], _LETTERBOX_BUF.transpose(2, 0, 1))
+        np.divide(_YOLO_BUF, 255.0, out=_YOLO_BUF)
+        # IOBinding hands the buffer to ONNXRuntime without another copy
+        binding = session.io_binding()
+        binding.bind_cpu_input("images", _YOLO_BUF)
+        binding.bind_output(session.get_outputs()[0].name)
+        session.run_with_iobinding(binding)
+        # Output is (1, 84, anchors): cx, cy, w, h followed by 80 class scores
+        pred = binding.copy_outputs_to_cpu()[0][0]
+
+    person_scores = pred[4]
+    best = int(person_scores.argmax())
+    if person_scores[best] < YOLO_CONF:
+        return None
+    cx, cy, bw, bh = pred[:4, best].astype(np.float64)
+    h, w = img.shape[:2]
+    box = np.array([
+        (cx - bw / 2 - pad_x) / scale / w,
+        (cy - bh / 2 - pad_y) / scale / h,
+        (cx + bw / 2 - pad_x) / scale / w,
+        (cy + bh / 2 - pad_y) / scale / h,
+    ])
+    return np.clip(box, 0, 1).round(3).tolist()
+
+def _run_pose(img):
+    pose_lite, pose_full = get_pose()
+    pose_results = pose_lite.process(img)
+    if pose_results.pose_landmarks is None:
+        pose_results = pose_full.process(img)
+    return pose_results
+
+def process_cv_grounding(image_bytes):
     """
     Uses YOLOv8 and MediaPipe to extract high-precision spatial data.
     """
-    img_bytes = base64.b64decode(image_b64)
-    nparr = np.frombuffer(img_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    img = _decode_image(image_bytes)
     if img is None:
         return {"person_detected": False, "landmarks": {}, "spatial_hints": "IMAGE_DECODE_ERROR"}
     
@@ -41,35 +203,84 @@ def process_cv_grounding(image_b64):
         "spatial_hints": ""
     }
 
+    # MediaPipe runs alongside the YOLO pass
+    pose_future = pose_pool.submit(_run_pose, img)
+
     # 1. YOLOv8 Person Detection
-    if yolo_model:
-        results = yolo_model(img, classes=[0], verbose=False)
-        if len(results) > 0 and len(results[0].boxes) > 0:
+    try:
+        yolo_model = get_yolo()
+    except Exception as e:
+        print(f"YOLO Initialization Warning: {e}")
+        cv_telemetry["yolo_error"] = str(e)
+        yolo_model = None
+    if yolo_model is not None:
+        box = _detect_person(yolo_model, img)
+        if box is not None:
             cv_telemetry["person_detected"] = True
-            box = results[0].boxes[0].xyxyn[0].tolist()
-            box = [round(x, 3) for x in box]
             cv_telemetry["spatial_hints"] += f"SUBJECT_BOX: {box}. "
 
     # 2. MediaPipe Pose Estimation
-    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    pose_results = pose_engine.process(img_rgb)
+    pose_results = pose_future.result()
     
     if pose_results.pose_landmarks:
         lm = pose_results.pose_landmarks.landmark
-        critical_points = {
-            "L_Shoulder": [round(lm[mp_pose.PoseLandmark.LEFT_SHOULDER].x, 3), round(lm[mp_pose.PoseLandmark.LEFT_SHOULDER].y, 3)],
-            "R_Shoulder": [round(lm[mp_pose.PoseLandmark.RIGHT_SHOULDER].x, 3), round(lm[mp_pose.PoseLandmark.RIGHT_SHOULDER].y, 3)],
-            "L_Hip": [round(lm[mp_pose.PoseLandmark.LEFT_HIP].x, 3), round(lm[mp_pose.PoseLandmark.LEFT_HIP].y, 3)],
-            "R_Hip": [round(lm[mp_pose.PoseLandmark.RIGHT_HIP].x, 3), round(lm[mp_pose.PoseLandmark.RIGHT_HIP].y, 3)],
-        }
+        lm_arr = np.fromiter((v for p in lm for v in (p.x, p.y)), dtype=np.float32, count=2 * len(lm)).reshape(-1, 2)
+        critical_arr = lm_arr[CRITICAL_LANDMARKS]
+        points = np.round(critical_arr.astype(np.float64), 3).tolist()
+        critical_points = dict(zip(CRITICAL_LANDMARK_NAMES, points))
         cv_telemetry["landmarks"] = critical_points
-        cv_telemetry["spatial_hints"] += f"SKELETON_MAP: {json.dumps(critical_points)}. "
+        # Compact key=x,y form costs far fewer prompt tokens than JSON
+        (lsx, lsy), (rsx, rsy), (lhx, lhy), (rhx, rhy) = points
+        cv_telemetry["spatial_hints"] += (
+            f"SKELETON_MAP (L/R shoulder, L/R hip): LS={lsx},{lsy};RS={rsx},{rsy};LH={lhx},{lhy};RH={rhx},{rhy}. "
+        )
+
+        torso_box, shoulder_width, torso_height, tilt_angle = _compute_skeleton_metrics(critical_arr, img.shape[1] / img.shape[0])
+        metrics = {
+            "torso_box": np.round(torso_box, 3).tolist(),
+            "shoulder_width": round(shoulder_width, 3),
+            "torso_height": round(torso_height, 3),
+            "tilt_angle": round(tilt_angle, 1),
+        }
+        cv_telemetry["skeleton_metrics"] = metrics
+        cv_telemetry["spatial_hints"] += (
+            f"SKELETON_METRICS (shoulder width, torso height as fractions of image height; tilt deg): W={metrics['shoulder_width']};H={metrics['torso_height']};TILT={metrics['tilt_angle']}. "
+        )
 
     return cv_telemetry
 
-def analyze_try_on(person_b64, top_b64, bottom_b64, dress_b64, gender):
+# Load and warm everything at import so the first request doesn't pay for it
+try:
+    get_yolo()
+except Exception as e:
+    print(f"YOLO Initialization Warning: {e}")
+get_pose()
+
+def _build_garment_parts(garments):
+    """
+    Flattens (label, image_bytes) pairs into alternating text/image parts,
+    skipping empty slots.
+    """
+    parts = []
+    for label, data in garments:
+        if data:
+            parts.append(types.Part.from_text(text=label))
+            parts.append(types.Part.from_bytes(data=data, mime_type="image/jpeg"))
+    return parts
+
+async def analyze_try_on(person_bytes, top_bytes, bottom_bytes, dress_bytes, gender, cv_task):
+    """
+    Garment manifest pass. cv_task is the CV grounding task; the prompt carries
+    its SKELETON_MAP, so the request only goes out once CV has finished.
+    """
     client = get_client()
-    cv_data = process_cv_grounding(person_b64)
+    image_parts = _build_garment_parts([
+        ("TARGET_PERSON:", person_bytes),
+        ("SOURCE_TOP (Exact design source):", top_bytes),
+        ("SOURCE_BOTTOM (Exact texture source):", bottom_bytes),
+        ("SOURCE_DRESS (Exact pattern source):", dress_bytes),
+    ])
+    cv_data = await cv_task
     
     prompt = f"""
     Act as a Neural Fashion Analysis Engine for High-Fidelity Try-On. 
@@ -80,25 +291,13 @@ def analyze_try_on(person_b64, top_b64, bottom_b64, dress_b64, gender):
     - Create a manifest to ensure PIXEL-PERFECT preservation of these assets.
     - Map garment landmarks to the SKELETON_MAP provided.
     - MUST NOT hallucinate generic designs.
+    - In garmentManifest, describe ONLY the garments (logos, textures, patterns,
+      construction). Do not mention the person, their pose, body or the SKELETON_MAP.
     """
     
-    contents = [
-        types.Part.from_text(text=prompt),
-        types.Part.from_text(text="TARGET_PERSON:"),
-        types.Part.from_bytes(data=base64.b64decode(person_b64), mime_type="image/jpeg")
-    ]
-    
-    if top_b64:
-        contents.append(types.Part.from_text(text="SOURCE_TOP (Exact design source):"))
-        contents.append(types.Part.from_bytes(data=base64.b64decode(top_b64), mime_type="image/jpeg"))
-    if bottom_b64:
-        contents.append(types.Part.from_text(text="SOURCE_BOTTOM (Exact texture source):"))
-        contents.append(types.Part.from_bytes(data=base64.b64decode(bottom_b64), mime_type="image/jpeg"))
-    if dress_b64:
-        contents.append(types.Part.from_text(text="SOURCE_DRESS (Exact pattern source):"))
-        contents.append(types.Part.from_bytes(data=base64.b64decode(dress_b64), mime_type="image/jpeg"))
-
-    response = client.models.generate_content(
+    contents = [types.Part.from_text(text=prompt)] + image_parts
+
+    response = await client.aio.models.generate_content(
         model='gemini-3-flash-preview',
         contents=contents,
         config=types.GenerateContentConfig(
@@ -111,6 +310,7 @@ def analyze_try_on(person_b64, top_b64, bottom_b64, dress_b64, gender):
                     "personDescription": {"type": "STRING"},
                     "bodySize": {"type": "STRING"},
                     "technicalPrompt": {"type": "STRING"},
+                    "garmentManifest": {"type": "STRING"},
                     "stylingSuggestions": {
                         "type": "OBJECT",
                         "properties": {
@@ -121,7 +321,7 @@ def analyze_try_on(person_b64, top_b64, bottom_b64, dress_b64, gender):
                         }
                     }
                 },
-                "required": ["garmentDescription", "personDescription", "bodySize", "technicalPrompt", "stylingSuggestions"]
+                "required": ["garmentDescription", "personDescription", "bodySize", "technicalPrompt", "garmentManifest", "stylingSuggestions"]
             }
         )
     )
@@ -129,9 +329,8 @@ def analyze_try_on(person_b64, top_b64, bottom_b64, dress_b64, gender):
     result["cv_telemetry"] = cv_data
     return result
 
-def generate_virtual_try_on_image(person_b64, top_b64, bottom_b64, dress_b64, technical_prompt, body_size, gender):
+async def generate_virtual_try_on_image(person_bytes, top_bytes, bottom_bytes, dress_bytes, technical_prompt, body_size, gender, cv_data):
     client = get_client()
-    cv_data = process_cv_grounding(person_b64)
     
     prompt = f"""
     MANDATORY PIXEL-PERFECT RENDER.
@@ -145,28 +344,67 @@ def generate_virtual_try_on_image(person_b64, top_b64, bottom_b64, dress_b64, te
     4. Drape fabrics according to the SKELETON_MAP points.
     """
     
-    contents = [
-        types.Part.from_text(text=prompt),
-        types.Part.from_text(text="TARGET_PERSON:"),
-        types.Part.from_bytes(data=base64.b64decode(person_b64), mime_type="image/jpeg")
-    ]
-    
-    if top_b64:
-        contents.append(types.Part.from_text(text="SOURCE_TOP (Preserve this exact logo):"))
-        contents.append(types.Part.from_bytes(data=base64.b64decode(top_b64), mime_type="image/jpeg"))
-    if bottom_b64:
-        contents.append(types.Part.from_text(text="SOURCE_BOTTOM (Preserve this exact fabric):"))
-        contents.append(types.Part.from_bytes(data=base64.b64decode(bottom_b64), mime_type="image/jpeg"))
-    if dress_b64:
-        contents.append(types.Part.from_text(text="SOURCE_DRESS (Preserve this exact pattern):"))
-        contents.append(types.Part.from_bytes(data=base64.b64decode(dress_b64), mime_type="image/jpeg"))
-
-    response = client.models.generate_content(
+    contents = [types.Part.from_text(text=prompt)] + _build_garment_parts([
+        ("TARGET_PERSON:", person_bytes),
+        ("SOURCE_TOP (Preserve this exact logo):", top_bytes),
+        ("SOURCE_BOTTOM (Preserve this exact fabric):", bottom_bytes),
+        ("SOURCE_DRESS (Preserve this exact pattern):", dress_bytes),
+    ])
+
+    # Stream so we can return on the first image part instead of waiting for
+    # any trailing text chunks
+    async for chunk in await client.aio.models.generate_content_stream(
         model='gemini-2.5-flash-image',
         contents=contents
-    )
-    
-    for part in response.candidates[0].content.parts:
-        if part.inline_data:
-            return f"data:{part.inline_data.mime_type};base64,{base64.b64encode(part.inline_data.data).decode()}"
+    ):
+        if not chunk.candidates or not chunk.candidates[0].content:
+            continue
+        for part in chunk.candidates[0].content.parts or []:
+            if part.inline_data:
+                return f"data:{part.inline_data.mime_type};base64,{base64.b64encode(part.inline_data.data).decode()}"
     return None
+
+async def synthesize_try_on(person_bytes, top_bytes, bottom_bytes, dress_bytes, gender, cached_prompt=None):
+    """
+    Runs CV grounding in a worker thread, then the analysis and the render.
+    Both prompts need the CV telemetry, so on the normal path the three steps
+    run one after another. Only when a garmentManifest cached from an earlier
+    run on the same garments is supplied does the render go out alongside the
+    analysis. The returned analysis carries the manifest the render used
+    under renderManifest.
+    """
+    cv_task = asyncio.create_task(asyncio.to_thread(process_cv_grounding, person_bytes))
+    analysis_task = asyncio.create_task(
+        analyze_try_on(person_bytes, top_bytes, bottom_bytes, dress_bytes, gender, cv_task)
+    )
+
+    if cached_prompt is not None:
+        # The cached garmentManifest is person-independent; body size must not
+        # come from whoever was analyzed before, so fall back to the default
+        render_manifest = {"technicalPrompt": cached_prompt, "bodySize": 'M', "source": "cached_garment_manifest"}
+    else:
+        analysis = await analysis_task
+        render_manifest = {
+            "technicalPrompt": analysis['technicalPrompt'],
+            "bodySize": analysis.get('bodySize', 'M'),
+            "source": "analysis"
+        }
+    cv_data = await cv_task
+    result_img = await generate_virtual_try_on_image(
+        person_bytes, top_bytes, bottom_bytes, dress_bytes,
+        render_manifest['technicalPrompt'],
+        render_manifest['bodySize'],
+        gender,
+        cv_data=cv_data
+    )
+
+    try:
+        analysis = await analysis_task
+    except Exception as e:
+        if result_img is None:
+            raise
+        # Speculative render already succeeded; keep it rather than the error
+        analysis = {"cv_telemetry": cv_data, "analysisError": str(e)}
+    # Record what the render actually used alongside the fresh analysis
+    analysis["renderManifest"] = render_manifest
+    return analysis, result_img
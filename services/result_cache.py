@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import base64
+import hashlib
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "vton")
+CACHE_TTL = 3600
+CACHE_MAX_ENTRIES = 64
+
+def _content_key(assets, gender):
+    # Each asset is hashed on its own so a missing slot can't be confused
+    # with bytes shifted between slots
+    h = hashlib.blake2b()
+    for data in assets:
+        h.update(hashlib.blake2b(data or b"").digest())
+    h.update(gender.encode())
+    return h.hexdigest()
+
+def result_key(person_bytes, top_bytes, bottom_bytes, dress_bytes, gender):
+    """
+    Content address for a synthesis request.
+    """
+    return _content_key((person_bytes, top_bytes, bottom_bytes, dress_bytes), gender)
+
+def manifest_key(top_bytes, bottom_bytes, dress_bytes, gender):
+    """
+    Content address for the person-independent garmentManifest. The person
+    is deliberately left out so a manifest carries over to a new portrait.
+    """
+    return _content_key((top_bytes, bottom_bytes, dress_bytes), gender)
+
+def _paths(key):
+    return os.path.join(CACHE_DIR, f"{key}.json"), os.path.join(CACHE_DIR, f"{key}.png")
+
+def load_result(key):
+    json_path, img_path = _paths(key)
+    try:
+        if time.time() - os.path.getmtime(json_path) > CACHE_TTL:
+            return None
+        with open(json_path) as f:
+            meta = json.load(f)
+        with open(img_path, "rb") as f:
+            img_bytes = f.read()
+    except (OSError, ValueError):
+        return None
+    image = f"data:{meta['mime_type']};base64,{base64.b64encode(img_bytes).decode()}"
+    return {"image": image, "analysis": meta["analysis"]}
+
+def save_result(key, result):
+    """
+    Persists the analysis JSON and decoded image, then trims the store to the
+    newest CACHE_MAX_ENTRIES results.
+    """
+    header, img_b64 = result["image"].split(",", 1)
+    mime_type = header[len("data:"):].split(";")[0]
+    json_path, img_path = _paths(key)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(img_path, "wb") as f:
+            f.write(base64.b64decode(img_b64))
+        # JSON last: its presence marks the entry as complete
+        with open(json_path, "w") as f:
+            json.dump({"mime_type": mime_type, "analysis": result["analysis"]}, f)
+
+        entries = sorted(
+            (os.path.join(CACHE_DIR, name) for name in os.listdir(CACHE_DIR) if name.endswith(".json")),
+            key=os.path.getmtime,
+            reverse=True
+        )
+        for stale in entries[CACHE_MAX_ENTRIES:]:
+            for path in _paths(os.path.basename(stale)[:-len(".json")]):
+                if os.path.exists(path):
+                    os.remove(path)
+    except OSError as e:
+        print(f"Result Cache Warning: {e}")